@@ -6,134 +6,389 @@
 ###########################################################################################################
 '''
 
-def realtime_price_publisher(ticker, port):
+class SharedPriceSlot:
     '''
-    A real-time price publisher for a given ticker.
-    The publisher sends the latest price data to a socket.
+    A single price record in POSIX shared memory, used to pass the latest price between processes on the same host.
+    The record is guarded by a sequence number: the writer makes it odd while writing and even when done,
+    so a reader can detect and retry a torn read without any locking or syscalls.
 
-    :param ticker: The ticker symbol to publish data for.
+    :param name: The name of the shared memory block.
+    :param create: If True, creates the block (publisher side). If False, attaches to an existing block (reader side).
+    '''
+    # Layout: seq, price, time (ns), symbol
+    SEQ_FORMAT = '<Q'
+    PAYLOAD_FORMAT = '<d q 16s'
+    # Give up a read after this many torn attempts, e.g. if the writer died mid-update and left seq odd
+    MAX_READ_RETRIES = 100
+
+    def __init__(self, name, create=False):
+        import struct
+        from multiprocessing import shared_memory
+
+        self.seq_struct = struct.Struct(self.SEQ_FORMAT)
+        self.payload_struct = struct.Struct(self.PAYLOAD_FORMAT)
+        size = self.seq_struct.size + self.payload_struct.size
+        self.owner = create
+        self.last_seq = 0
+
+        if create:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # Left behind by a previous run that did not exit cleanly
+                self.shm = shared_memory.SharedMemory(name=name, create=False)
+            self.shm.buf[:size] = bytes(size)
+        else:
+            # Readers must not unlink the block on exit, only the publisher owns it
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=False, track=False)
+            except TypeError:
+                # Python < 3.13 has no track argument, untrack after attaching instead
+                self.shm = shared_memory.SharedMemory(name=name, create=False)
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.buf = self.shm.buf
+
+    def write(self, symbol, price, time_ns):
+        '''
+        Writes a new price record. Only one process may write to a slot.
+        '''
+        seq = self.seq_struct.unpack_from(self.buf, 0)[0]
+        self.seq_struct.pack_into(self.buf, 0, seq + 1)  # Odd, write in progress
+        self.payload_struct.pack_into(self.buf, self.seq_struct.size, price, time_ns, symbol.encode())
+        self.seq_struct.pack_into(self.buf, 0, seq + 2)  # Even, write complete
+
+    def read(self):
+        '''
+        Reads the latest price record.
+
+        :return: A dict with 'symbol', 'price' and 'time', or None if no new record was written since the last read
+            or no consistent record could be read within MAX_READ_RETRIES attempts.
+        '''
+        for _ in range(self.MAX_READ_RETRIES):
+            seq = self.seq_struct.unpack_from(self.buf, 0)[0]
+            if seq == self.last_seq:
+                return None
+            if seq % 2:
+                continue  # Writer is mid-update, retry
+            price, time_ns, symbol = self.payload_struct.unpack_from(self.buf, self.seq_struct.size)
+            if self.seq_struct.unpack_from(self.buf, 0)[0] == seq:
+                self.last_seq = seq
+                return {
+                    'symbol': symbol.rstrip(b'\0').decode(),
+                    'price': price,
+                    'time': time_ns
+                }
+        return None
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def shared_price_slot_name(port, ticker):
+    '''
+    Returns the shared memory block name for a ticker of the publisher on a given port.
+    '''
+    return f"tradingagent-{port}-{ticker}"
+
+# Set by main.py when all children run as threads of one process and share its ZeroMQ context
+INPROC_ENDPOINTS = False
+
+def endpoint_path(port):
+    '''
+    Returns the Unix domain socket file of a local socket on a given port.
+    '''
+    return f"/tmp/tradingagent-{port}"
+
+def endpoint(port):
+    '''
+    Returns the ZeroMQ endpoint for a local socket on a given port.
+    Local sockets use Unix domain sockets (ipc) instead of TCP to skip the TCP/IP stack,
+    the port number only serves as a unique socket file suffix.
+    When children run as threads, sockets use the inproc transport instead, passing messages in memory without syscalls.
+    '''
+    if INPROC_ENDPOINTS:
+        return f"inproc://tradingagent-{port}"
+    return f"ipc://{endpoint_path(port)}"
+
+def exit_on_sigterm():
+    '''
+    Makes SIGTERM raise SystemExit, so finally blocks clean up when main.py terminates the process.
+    Signal handlers can only be installed from the main thread, threaded children are stopped with their stop event instead.
+    '''
+    import signal, threading
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    def handler(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, handler)
+
+def unpack_price_frames(frames, tickers):
+    '''
+    Decodes the aggregated prices sent by realtime_prices_manager, only for the tickers of interest.
+    The aggregated message is a multipart message of alternating ticker and MessagePack encoded price frames.
+
+    :param frames: The received frames, as zmq.Frame objects.
+    :param tickers: A collection of ticker symbols to decode prices for.
+    :return: A dict of ticker symbol -> price data.
+    '''
+    import msgpack
+    prices = {}
+    for i in range(0, len(frames) - 1, 2):
+        ticker = frames[i].bytes.decode()
+        if ticker in tickers:
+            prices[ticker] = msgpack.unpackb(frames[i + 1].buffer, raw=False)
+    return prices
+
+def realtime_price_publisher(tickers, port, serve_remote=False, stop_event=None):
+    '''
+    A real-time price publisher for a list of tickers.
+    The publisher writes the latest price data of each ticker to shared memory for local consumers.
+    If serving remote consumers, it also sends it to a socket, as one message per ticker prefixed with the ticker as topic.
+
+    :param tickers: A list of ticker symbols to publish data for.
     :param port: The port to publish data to.
+    :param serve_remote: If True, also publishes on tcp://*:port for managers on other hosts.
+    :param stop_event: A threading.Event that stops the publisher when set. If None, runs until terminated.
     :return: None
     '''
     # Better to import inside function due to multiprocessing
     import zmq, time
-    
-    context = zmq.Context()
-    socket = context.socket(zmq.PUB)
-    socket.bind(f"tcp://*:{port}")
-
-    def get_realtime_price(i):
-        price = 100.0 + i/10
-        return {
-            'symbol': ticker,
-            'price': price,
-            'time': time.time()
-        }
+    import msgpack
+    import threading
+
+    # Unlink the shared memory blocks on shutdown
+    exit_on_sigterm()
+    if stop_event is None:
+        stop_event = threading.Event()  # Never set
+
+    socket = None
+    if serve_remote:
+        # Reuse one packer per process to avoid re-creating encoder state each tick
+        packer = msgpack.Packer(use_bin_type=True)
+
+        # One shared context per process, it is not terminated since other sockets in the process may use it
+        context = zmq.Context.instance(io_threads=1)
+        socket = context.socket(zmq.PUB)
+        # HWM must be set before bind, otherwise it is silently ignored
+        socket.setsockopt(zmq.SNDHWM, len(tickers))  # Room for one tick of every ticker, do not queue stale prices
+        socket.setsockopt(zmq.LINGER, 0)  # Drop unsent messages on close
+        socket.bind(f"tcp://*:{port}")  # TCP, since only remote consumers use this socket
+
+    # Local consumers read from shared memory, skipping socket copies and deserialization
+    slots = [SharedPriceSlot(shared_price_slot_name(port, ticker), create=True) for ticker in tickers]
+    topics = [ticker.encode() for ticker in tickers]
+
+    # One price dict per ticker, updated in place every tick instead of allocating a new one
+    latest_prices = [{'symbol': ticker, 'price': 0.0, 'time': 0} for ticker in tickers]
+
+    def update_realtime_price(price_data, i):
+        price_data['price'] = 100.0 + i/10
+        price_data['time'] = time.time_ns()
+        return price_data
 
     try:
         # Main loop, continuously send latest price data
+        # Schedule against a monotonic deadline so the tick cadence does not drift
+        interval = 0.01
+        next_time = time.monotonic()
         i = 0
-        while True:
-            time.sleep(0.01)
+        while not stop_event.is_set():
+            next_time += interval
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
             i += 1
-            latest_price = get_realtime_price(i)
-            socket.send_json(latest_price)  # Send latest data
+            for price_data, topic, slot in zip(latest_prices, topics, slots):
+                latest_price = update_realtime_price(price_data, i)
+                slot.write(latest_price['symbol'], latest_price['price'], latest_price['time'])
+                if socket is not None:
+                    socket.send_multipart([topic, packer.pack(latest_price)], copy=False, track=False)  # Send latest data
     except Exception as e:
         print(f"Process encountered an error: {e}")
         raise e
     finally:
         # Clean up
-        socket.close()
-        context.term()
-        print("Socket and context closed.")
+        for slot in slots:
+            slot.close()
+        if socket is not None:
+            socket.close()
+        print("Shared memory and socket closed.")
 
-def realtime_prices_manager(tickers, consume_ports, port):
+def realtime_prices_manager(tickers, consume_port, port, stop_event=None):
     '''
-    Manages real-time price publishers for multiple tickers.
+    Manages the real-time price publisher for multiple tickers.
     The manager consumes the latest price data for each ticker and sends it to an aggregate publisher.
-    Design note: The choice to separate individual publishers is aimed at decreasing latency in price updates.
 
     :param tickers: A list of ticker symbols to manage.
-    :param consume_ports: A list of ports to consume data from.
+    :param consume_port: The port of the publisher to consume data from.
+        An integer port is a local publisher and is read from shared memory.
+        A "host:port" string is a remote publisher started with serve_remote=True, and is consumed over ZeroMQ.
     :param port: The port to publish aggregated data to.
+    :param stop_event: A threading.Event that stops the manager when set. If None, runs until terminated.
     :return: None
     '''
     # Better to import inside function due to multiprocessing
-    import zmq, time
-    context = zmq.Context()
+    import zmq
+    import msgpack
+    import os, threading
+
+    # Remove the ipc socket file on shutdown
+    exit_on_sigterm()
+    if stop_event is None:
+        stop_event = threading.Event()  # Never set
+
+    # Reuse one packer per process to avoid re-creating encoder state each tick
+    packer = msgpack.Packer(use_bin_type=True)
+
+    # Shared context of the process
+    context = zmq.Context.instance(io_threads=1)
 
     # Create a socket to publish aggregated data
     publish_socket = context.socket(zmq.PUB)
-    publish_socket.bind(f"tcp://*:{port}")
-
-    # Create sockets to consume data from each ticker
-    consume_sockets = []
-    for consume_port in consume_ports:
-        socket = context.socket(zmq.SUB)
-        socket.setsockopt(zmq.CONFLATE, 1)  # Keep only the latest message
-        socket.setsockopt(zmq.SUBSCRIBE, b"")
-        socket.connect(f"tcp://localhost:{consume_port}")
-        consume_sockets.append(socket)
-    
+    # HWM must be set before bind, otherwise it is silently ignored
+    publish_socket.setsockopt(zmq.SNDHWM, 1)  # Do not queue stale prices
+    publish_socket.setsockopt(zmq.LINGER, 0)  # Drop unsent messages on close
+    publish_socket.bind(endpoint(port))
+
+    consume_slots = []
+    consume_socket = None
+
+    # Persistent across iterations, tickers without a new message keep their last price
+    aggregated_prices = {}
+
     def get_aggregated_prices():
-        aggregated_prices = {}
-        for socket in consume_sockets:
-            latest_price = socket.recv_json()
-            aggregated_prices[latest_price['symbol']] = latest_price
+        for slot in consume_slots:
+            latest_price = slot.read()
+            if latest_price is not None:
+                aggregated_prices[latest_price['symbol']] = latest_price
+        if consume_socket is not None:
+            # Drain the socket, only the newest message of each ticker is kept
+            while True:
+                try:
+                    _, message = consume_socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+                latest_price = msgpack.unpackb(message.buffer, raw=False)
+                aggregated_prices[latest_price['symbol']] = latest_price
         return aggregated_prices
-    
+
     try:
+        # Attach to shared memory of a local publisher, or create a socket for a remote one
+        if isinstance(consume_port, int):
+            for ticker in tickers:
+                while not stop_event.is_set():
+                    try:
+                        consume_slots.append(SharedPriceSlot(shared_price_slot_name(consume_port, ticker)))
+                        break
+                    except FileNotFoundError:
+                        stop_event.wait(0.1)  # Publisher has not created its shared memory yet
+        else:
+            consume_socket = context.socket(zmq.SUB)
+            # CONFLATE does not support multipart messages, keep room for one message per ticker instead
+            consume_socket.setsockopt(zmq.RCVHWM, len(tickers))  # Set before connect, otherwise ignored
+            consume_socket.setsockopt(zmq.LINGER, 0)
+            for ticker in tickers:
+                consume_socket.setsockopt(zmq.SUBSCRIBE, ticker.encode())
+            consume_socket.connect(f"tcp://{consume_port}")
+
         # Main loop, continuously aggregate latest price data
-        while True:
+        while not stop_event.is_set():
             latest_prices = get_aggregated_prices()
-            publish_socket.send_json(latest_prices)  # Send aggregated data
-            time.sleep(1)  # Delay
+            # One frame pair per ticker, so consumers only decode the tickers they need
+            frames = []
+            for symbol, price_data in latest_prices.items():
+                frames.append(symbol.encode())
+                frames.append(packer.pack(price_data))
+            if frames:
+                publish_socket.send_multipart(frames, copy=False)  # Send aggregated data
+            stop_event.wait(1)  # Delay
     except Exception as e:
         print(f"Process encountered an error: {e}")
         raise e
     finally:
         # Clean up
-        for socket in consume_sockets:
-            socket.close()
+        for slot in consume_slots:
+            slot.close()
+        if consume_socket is not None:
+            consume_socket.close()
         publish_socket.close()
-        context.term()
-        print("Sockets and context closed.")
+        # libzmq leaves the ipc socket file behind, there is none for inproc
+        try:
+            os.remove(endpoint_path(port))
+        except FileNotFoundError:
+            pass
+        print("Shared memory and sockets closed.")
 
-def realtime_price_display_consumer(tickers, port):
+def realtime_price_display_consumer(tickers, port, stop_event=None):
     '''
     A real-time price consumer that subscribes to an aggregated price publisher and prints the latest prices.
+    Printing happens on a separate thread, so slow terminal IO never holds up receiving prices.
     
     :param tickers: A list of ticker symbols to display prices for.
     :param port: The port to consume data from.
+    :param stop_event: A threading.Event that stops the consumer when set. If None, runs until terminated.
     :return: None
     '''
     # Better to import inside function due to multiprocessing
     import zmq, time
-    context = zmq.Context()
+    import queue, threading
+
+    if stop_event is None:
+        stop_event = threading.Event()  # Never set
+
+    # Shared context of the process
+    context = zmq.Context.instance(io_threads=1)
     socket = context.socket(zmq.SUB)
-    socket.setsockopt(zmq.CONFLATE, 1)  # Keep only the latest message
+    # CONFLATE does not support multipart messages, the main loop drains to the latest message instead
+    socket.setsockopt(zmq.RCVHWM, 1)  # Set before connect, otherwise ignored
+    socket.setsockopt(zmq.LINGER, 0)
     socket.setsockopt(zmq.SUBSCRIBE, b"")
-    socket.connect(f"tcp://localhost:{port}")
+    socket.connect(endpoint(port))
+
+    # Holds only the latest prices, the printer thread skips anything it did not get to
+    latest_prices_queue = queue.Queue(maxsize=1)
 
     def print_realtime_price(prices):
-        time.sleep(1)
-        #return
         for ticker in tickers:
             price_data = prices.get(ticker)
             if price_data:
                 print(f"'{ticker}': {price_data['price']} ({price_data['time']})")
         print()
 
+    def printer():
+        while True:
+            print_realtime_price(latest_prices_queue.get())
+            time.sleep(1)
+
+    threading.Thread(target=printer, daemon=True).start()
+
     try:
         # Main loop, continuously display latest price data
-        while True:
-            latest_prices = socket.recv_json()
-            print_realtime_price(latest_prices)
+        while not stop_event.is_set():
+            if not socket.poll(1000):
+                continue  # Time out regularly to check the stop event
+            frames = socket.recv_multipart(copy=False)
+            # Keep only the latest message
+            while True:
+                try:
+                    frames = socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+            latest_prices = unpack_price_frames(frames, tickers)
+            # Replace the prices the printer has not picked up yet, never block on it
+            try:
+                latest_prices_queue.get_nowait()
+            except queue.Empty:
+                pass
+            latest_prices_queue.put_nowait(latest_prices)
     except Exception as e:
         print(f"Process encountered an error: {e}")
         raise e
     finally:
         # Clean up
         socket.close()
-        context.term()
-        print("Socket and context closed.")
+        print("Socket closed.")
@@ -8,12 +8,33 @@
 #                                                                             #
 ###############################################################################
 
-import time
+import sys
+import threading
 import multiprocessing
+from multiprocessing.connection import wait
 
+import dataModule
 from tradingModule import individual_trade_execution
 from dataModule import realtime_price_publisher, realtime_prices_manager, realtime_price_display_consumer
 
+def gil_disabled():
+    '''
+    Checks whether children can run as threads without the GIL, on free-threaded Python builds (PEP 703).
+    Importing an extension module without free-threading support turns the GIL back on at runtime,
+    so the extensions the children use are imported before checking.
+
+    :return: True if the GIL stays disabled after importing the children's dependencies.
+    '''
+    if getattr(sys, '_is_gil_enabled', lambda: True)():
+        return False
+    import zmq, zmq.asyncio, msgpack, dotenv
+    import alpaca.trading.client, alpaca.trading.stream
+    return not sys._is_gil_enabled()
+
+# Without the GIL, run children as threads of this process instead of separate processes.
+# Local ZeroMQ sockets then use the inproc transport, so messages stay in memory within the shared context.
+THREADED = gil_disabled()
+
 class ChildrenProcessesData:
     '''
     A class to store data about child processes and ports.
@@ -26,14 +47,31 @@ class ChildrenProcessesData:
         self.next_free_port = initial_port
         self.max_port = max_port
         self.child_processes = []
+        self.child_exited = threading.Event()  # Set when any threaded child exits
+        self.stop_event = threading.Event()  # Set to ask threaded children to clean up and exit
 
         if self.next_free_port > self.max_port:
             raise ValueError(f"Initial port {initial_port} exceeds maximum port {max_port}.")
 
+def run_and_notify(target, args, exited, stop_event):
+    '''
+    Runs a threaded child and sets an event when it exits, the threaded counterpart of a process sentinel.
+    
+    :param target: The target function to run.
+    :param args: A tuple of arguments to pass to the target function.
+    :param exited: The threading.Event to set when the target returns or raises.
+    :param stop_event: The threading.Event passed to the target, threads cannot be terminated so they are asked to stop.
+    '''
+    try:
+        target(*args, stop_event=stop_event)
+    finally:
+        exited.set()
+
 def register_process_with_port(target=None, args=None, need_port=False, cpd=None):
     '''
     Registers a process and assigns a specific port for the process to use.
     Always use this function to create a new process to ensure proper management of child processes.
+    On free-threaded builds, the target runs in a thread and must accept a stop_event keyword argument.
     
     :param target: The target function to run in the process.
     :param args: A tuple of arguments to pass to the target function.
@@ -57,8 +95,13 @@ def register_process_with_port(target=None, args=None, need_port=False, cpd=None
         new_port = None
         args_w_port = args
 
-    # Create the new process
-    process = multiprocessing.Process(target=target, args=args_w_port)
+    # Create the new process, or a thread on free-threaded builds
+    if THREADED:
+        process = threading.Thread(target=run_and_notify,
+                                   args=(target, args_w_port, cpd.child_exited, cpd.stop_event),
+                                   daemon=True)
+    else:
+        process = multiprocessing.Process(target=target, args=args_w_port)
 
     # Add the process to the list of child processes
     cpd.child_processes.append(process)
@@ -68,23 +111,20 @@ def register_process_with_port(target=None, args=None, need_port=False, cpd=None
 if __name__ == '__main__':
     tickers = ['AAPL', 'GOOGL', 'AMZN', 'MSFT', 'TSLA']
     child_processes_data = ChildrenProcessesData()
+    dataModule.INPROC_ENDPOINTS = THREADED
 
-    # Create realtime price processes for each ticker
-    realtime_price_ports = []
-    for ticker in tickers:
-        # Create a publisher for each ticker
-        publisher_process, publisher_port = register_process_with_port(
+    # Create a single realtime price process for all tickers
+    publisher_process, publisher_port = register_process_with_port(
                                                             target=realtime_price_publisher,
-                                                            args=(ticker,),
+                                                            args=(tickers,),
                                                             need_port=True,
                                                             cpd=child_processes_data
                                                         )
-        realtime_price_ports.append(publisher_port)
-    
+
     # Create a manager process to aggregate prices
     prices_manager_process, prices_manager_port = register_process_with_port(
                                                             target=realtime_prices_manager,
-                                                            args=(tickers, realtime_price_ports),
+                                                            args=(tickers, publisher_port),
                                                             need_port=True,
                                                             cpd=child_processes_data
                                                         )
@@ -114,19 +154,29 @@ if __name__ == '__main__':
             process.start()
 
         # Keep the main process alive while child processes run
-        while all([process.is_alive() for process in child_processes]):
-            time.sleep(1)
+        # Block until any child exits, no polling needed
+        if THREADED:
+            child_processes_data.child_exited.wait()
+        else:
+            wait([process.sentinel for process in child_processes])
 
     except Exception as e:
         print(f"An error occurred: {e}")
     finally:
-        # Terminate processes if they are still running
-        for process in child_processes:
-            if process.is_alive():
-                process.terminate()
-
-        # Wait for processes to terminate
-        for process in child_processes:
-            process.join()
+        if THREADED:
+            # Threads cannot be terminated, ask them to stop so they clean up their shared memory and sockets
+            child_processes_data.stop_event.set()
+            for process in child_processes:
+                if process.is_alive():
+                    process.join(timeout=5)
+        else:
+            # Terminate processes if they are still running
+            for process in child_processes:
+                if process.is_alive():
+                    process.terminate()
+
+            # Wait for processes to terminate
+            for process in child_processes:
+                process.join()
 
         print("Processes terminated.")
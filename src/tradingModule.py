@@ -6,25 +6,57 @@
 ###########################################################################################################
 '''
 
-def individual_trade_execution(ticker, port):
+class TickerTradeState:
+    '''
+    A class to store the locally cached trading state of a ticker: its position and open orders.
+    The cache is kept up to date by Alpaca's trade updates stream and by our own submit/cancel responses,
+    so trades do not need to poll Alpaca for the state on every price update.
+    Design note: like ChildrenProcessesData, this method-less class is shared between the stream and trading threads.
+    '''
+    # Number of removed order ids to remember, older ones are dropped
+    MAX_REMOVED_ORDER_IDS = 1000
+
+    def __init__(self):
+        import threading
+        from collections import OrderedDict
+        self.lock = threading.Lock()  # Guards all fields below
+        self.position_qty = None  # None if there is no open position
+        self.open_orders = {}  # Order id -> Order
+        # Orders cancelled by us or reported closed by the stream, oldest first.
+        # Late events or submit responses for these orders must not add them back as open.
+        self.removed_order_ids = OrderedDict()
+        self.dirty = True  # If True, the cache must be refreshed from Alpaca before use
+        self.subscribed = False  # True once Alpaca confirmed the trade updates subscription of the current connection
+        self.connection_id = 0  # Changes on every stream (re)connect and subscription, to detect refreshes racing them
+        self.event_count = 0  # Changes on every trade update of the ticker, to detect refreshes racing them
+        self.refreshed_at = 0.0  # time.monotonic() of the last refresh from Alpaca
+
+
+def individual_trade_execution(ticker, port, stop_event=None):
     '''
     Executes trade requests for a specific ticker from strategy modules.
     The trade execution process listens for trade requests and executes trades.
 
     :param ticker: The ticker symbol to execute trades for.
     :param port: The port to listen for trade requests on.
+    :param stop_event: A threading.Event that stops the trade execution when set. If None, runs until terminated.
     :return: None
     '''
     # Better to import inside function due to multiprocessing
     from dotenv import load_dotenv
     import os, time
 
+    import threading
     from alpaca.trading.client import TradingClient
+    from alpaca.trading.stream import TradingStream
     from alpaca.trading.requests import LimitOrderRequest, GetOrdersRequest
-    from alpaca.trading.enums import OrderSide, TimeInForce
+    from alpaca.trading.enums import OrderSide, OrderType, TimeInForce
     from alpaca.trading.enums import QueryOrderStatus
     from alpaca.trading.models import Order
 
+    if stop_event is None:
+        stop_event = threading.Event()  # Never set
+
     # Load Alpaca API keys from environment variables
     load_dotenv()
     #alpaca_api_key = os.environ.get("ALPACA_API_KEY")
@@ -39,43 +71,126 @@ def individual_trade_execution(ticker, port):
         print(f"Error initializing trading client: {e}")
     print(f"Trading client initialized for '{ticker}'.")
 
-    import zmq
-    context = zmq.Context()
+    # Keep the position and open orders of the ticker up to date from the trade updates stream
+    state = TickerTradeState()
+    # Events after which an order is no longer open
+    closed_order_events = {'fill', 'canceled', 'expired', 'rejected', 'done_for_day', 'replaced'}
+
+    def forget_order(order_id):
+        # Drop an order from the cache and remember it was removed, call with state.lock held
+        state.open_orders.pop(order_id, None)
+        state.removed_order_ids[order_id] = None
+        state.removed_order_ids.move_to_end(order_id)
+        while len(state.removed_order_ids) > TickerTradeState.MAX_REMOVED_ORDER_IDS:
+            state.removed_order_ids.popitem(last=False)
+
+    async def on_trade_update(data):
+        order = data.order
+        if order.symbol != ticker:
+            return
+        with state.lock:
+            state.event_count += 1
+            if data.event in closed_order_events:
+                forget_order(order.id)
+            elif order.id not in state.removed_order_ids:
+                # e.g. pending_cancel for an order we already cancelled must not reopen it
+                state.open_orders[order.id] = order
+            if data.event in ('fill', 'partial_fill') and data.position_qty is not None:
+                position_qty = float(data.position_qty)
+                state.position_qty = position_qty if position_qty != 0 else None
+
+    # Every trader process opens its own trade updates stream and ignores other tickers' events.
+    # This keeps traders independent like the rest of the design, a slow or crashed trader does not affect the others,
+    # and account-wide events are few compared to price updates. Sharing one stream would need another process and IPC hop.
+    # TradingStream has no public (re)connect hooks, the overrides below were written against alpaca-py 0.44.0.
+    # If those private methods are missing, run without the stream and poll Alpaca on every trade instead.
+    stream_hooks = ('_start_ws', '_dispatch', 'close')
+
+    class TrackedTradingStream(TradingStream):
+        # TradingStream reconnects silently on errors, and events during the gap are lost.
+        # Mark the cache dirty on every (re)connect and only trust it again once the subscription is confirmed.
+        async def _start_ws(self):
+            with state.lock:
+                state.subscribed = False
+                state.dirty = True
+                state.connection_id += 1
+            await super()._start_ws()
+
+        async def _dispatch(self, msg):
+            if msg.get("stream") == "listening" and "trade_updates" in msg.get("data", {}).get("streams", []):
+                with state.lock:
+                    state.subscribed = True
+                    state.dirty = True  # Refresh once more to cover events before the subscription
+                    state.connection_id += 1
+            await super()._dispatch(msg)
+
+        async def close(self):
+            with state.lock:
+                state.subscribed = False
+                state.dirty = True
+            await super().close()
+
+    try:
+        missing_hooks = [hook for hook in stream_hooks if not hasattr(TradingStream, hook)]
+        if missing_hooks:
+            raise AttributeError(f"TradingStream has no {', '.join(missing_hooks)}, unsupported alpaca-py version")
+        trading_stream = TrackedTradingStream(api_key=alpaca_paper_key, secret_key=alpaca_paper_secret, paper=True)
+        trading_stream.subscribe_trade_updates(on_trade_update)
+    except Exception as e:
+        print(f"TRADER WARNING: Error initializing trade updates stream for '{ticker}', polling Alpaca instead.\nError message: {e}")
+        trading_stream = None
+
+    def run_trading_stream():
+        try:
+            trading_stream.run()
+        except Exception as e:
+            print(f"TRADER WARNING: Trade updates stream stopped for '{ticker}', polling Alpaca instead.\nError message: {e}")
+        finally:
+            # Without the stream, the cache can no longer be trusted
+            with state.lock:
+                state.subscribed = False
+                state.dirty = True
+
+    if trading_stream is not None:
+        threading.Thread(target=run_trading_stream, daemon=True).start()
+
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    import zmq, zmq.asyncio
+    from dataModule import endpoint, unpack_price_frames
+    # Asyncio wrapper around the shared context of the process, so receiving prices overlaps with in-flight Alpaca requests
+    # The shared context is not terminated since other sockets in the process may use it
+    context = zmq.asyncio.Context.shadow(zmq.Context.instance(io_threads=1).underlying)
     socket = context.socket(zmq.SUB)
-    socket.setsockopt(zmq.CONFLATE, 1)  # Keep only the latest message
+    # CONFLATE does not support multipart messages, the main loop drains to the latest message instead
+    socket.setsockopt(zmq.RCVHWM, 1)  # Set before connect, otherwise ignored
+    socket.setsockopt(zmq.LINGER, 0)
     socket.setsockopt(zmq.SUBSCRIBE, b"")
-    socket.connect(f"tcp://localhost:{port}")
+    socket.connect(endpoint(port))
 
-    def execute_trade(ticker, buy_price, sell_price, buy_quantity):        
-        # Generate the order
+    def order_key(o):
+        # Everything that makes two orders equivalent, in one comparable tuple
+        return (o.side, round(float(o.limit_price), 2), round(float(o.qty), 2), o.time_in_force)
+
+    # Re-check the cache against Alpaca at least this often, in case the stream missed something
+    state_refresh_interval = 5
+
+    def refresh_state():
+        # Load the position and open orders from Alpaca, returns False on failure
+        with state.lock:
+            connection_id = state.connection_id
+            event_count = state.event_count
         try:
-            position = trading_client.get_open_position(ticker)
+            # Position.qty is a string, store a float since the order templates skip validation
+            position_qty = float(trading_client.get_open_position(ticker).qty)
+            if position_qty == 0:
+                position_qty = None
         except Exception as e:
             if "position does not exist" in e.message:
-                position = None
+                position_qty = None
             else:
                 print(f"TRADER WARNING: Error fetching position for '{ticker}': {e}")
-                return
-        if position is None and buy_price is not None:
-            # No position, buy
-            order_req = LimitOrderRequest(
-                        symbol = ticker,
-                        limit_price=buy_price,
-                        qty=buy_quantity,
-                        side=OrderSide.BUY,
-                        time_in_force=TimeInForce.DAY
-                        )
-        elif position is not None and sell_price is not None:
-            # Position exists, sell
-            order_req = LimitOrderRequest(
-                        symbol = ticker,
-                        limit_price=sell_price,
-                        qty=position.qty,
-                        side=OrderSide.SELL,
-                        time_in_force=TimeInForce.DAY
-                        )
-        
-        # Check for existing orders for the ticker
+                return False
         get_orders_data = GetOrdersRequest(
             status=QueryOrderStatus.OPEN,
             symbols=[ticker]
@@ -84,47 +199,151 @@ def individual_trade_execution(ticker, port):
             orders = trading_client.get_orders(filter=get_orders_data)
         except Exception as e:
             print(f"TRADER WARNING: Error fetching orders for '{ticker}', skip trading.\nError message: {e}")
+            return False
+        with state.lock:
+            if state.connection_id != connection_id or state.event_count != event_count:
+                # The stream reconnected or updated the state while the requests were in flight,
+                # so the snapshot may be older than the cache. Keep the cache and refresh again next trade.
+                state.dirty = True
+                return False
+            state.position_qty = position_qty
+            state.open_orders = {order.id: order for order in orders if order.id not in state.removed_order_ids}
+            # Only trust the cache from now on if the stream keeps it up to date
+            state.dirty = not state.subscribed
+            state.refreshed_at = time.monotonic()
+        return True
+
+    def cancel_order(order):
+        # Cancel an order and drop it from the cache
+        _ = trading_client.cancel_order_by_id(order.id)
+        with state.lock:
+            forget_order(order.id)
+
+    # Pre-built order requests, only price and quantity change between trades.
+    # model_construct skips pydantic validation on every trade, and also skips LimitOrderRequest.__init__,
+    # so the order type it would normally set must be given explicitly.
+    buy_order_req = LimitOrderRequest.model_construct(
+                symbol=ticker,
+                limit_price=0.0,
+                qty=0,
+                side=OrderSide.BUY,
+                type=OrderType.LIMIT,
+                time_in_force=TimeInForce.DAY
+                )
+    sell_order_req = LimitOrderRequest.model_construct(
+                symbol=ticker,
+                limit_price=0.0,
+                qty=0,
+                side=OrderSide.SELL,
+                type=OrderType.LIMIT,
+                time_in_force=TimeInForce.DAY
+                )
+
+    def execute_trade(ticker, buy_price, sell_price, buy_quantity):
+        # Only poll Alpaca when the cache is not trusted or due for a re-check
+        with state.lock:
+            dirty = state.dirty or time.monotonic() - state.refreshed_at > state_refresh_interval
+        if dirty and not refresh_state():
             return
+        with state.lock:
+            position_qty = state.position_qty
+            orders = list(state.open_orders.values())
+
+        # Generate the order
+        if position_qty is None and buy_price is not None:
+            # No position, buy
+            order_req = buy_order_req
+            order_req.limit_price = buy_price
+            order_req.qty = buy_quantity
+        elif position_qty is not None and sell_price is not None:
+            # Position exists, sell
+            order_req = sell_order_req
+            order_req.limit_price = sell_price
+            order_req.qty = position_qty
+
+        # Check for existing orders for the ticker
         if len(orders) > 1:
             # There should be at most one open order for the ticker.
             print(f"TRADER WARNING: Multiple open orders found for '{ticker}', this is bizarre! Clearing all pending orders.")
             for order in orders:
                 try:
-                    _ = trading_client.cancel_order_by_id(order.id)
+                    cancel_order(order)
                     print(f"Cancelled bizarre order: {order.symbol} {order.side}: {order.qty} @ {order.limit_price}")
                 except Exception as e:
                     print(f"TRADER WARNING: Error cancelling bizarre order for '{ticker}', skip trading.\nError message: {e}")
+                    with state.lock:
+                        state.dirty = True
                     return
         elif len(orders) == 1:
             # There is an existing order, only cancel if different from current order request
             # If we always cancel and resubmit, we might hit API rate limits
             order = orders[0]
-            if order_req.side != order.side \
-                or round(float(order_req.limit_price), 2) != round(float(order.limit_price), 2)\
-                or round(float(order_req.qty), 2) != round(float(order.qty), 2)\
-                or order_req.time_in_force != order.time_in_force:
+            if order_key(order_req) != order_key(order):
                 try:
-                    _ = trading_client.cancel_order_by_id(order.id)
+                    cancel_order(order)
                 except Exception as e:
                     print(f"TRADER WARNING: Error cancelling existing order for '{ticker}', skip trading.\nError message: {e}")
+                    with state.lock:
+                        state.dirty = True
                     return
             else:
                 # Order is the same, no need to execute
                 print(f"Order already exists for {ticker}, skipping trade.")
                 return None
-            
+
         # Execute the trade
         try:
             new_order = trading_client.submit_order(order_req)
         except Exception as e:
             print(f"Error submitting order: {e}")
+            with state.lock:
+                state.dirty = True
+            return None
+        with state.lock:
+            if new_order.id not in state.removed_order_ids:
+                state.open_orders[new_order.id] = new_order
         return new_order
-    
-    try:
-        last_buy, last_sell, last_qty = None, None, None
+
+    # The Alpaca client is synchronous, run its requests on a worker thread
+    executor = ThreadPoolExecutor(max_workers=1)
+    trade_lock = asyncio.Lock()  # At most one trade in flight for this ticker
+    last_trade = None  # Last trade that was executed
+    next_trade = None  # Trade for the freshest price, executed once the lock is free
+
+    async def trade_worker():
+        # Keep trading until the last executed trade matches the freshest price
+        nonlocal last_trade
+        loop = asyncio.get_running_loop()
+        async with trade_lock:
+            while next_trade != last_trade:
+                trade = next_trade
+                order = None
+                try:
+                    order = await loop.run_in_executor(executor, execute_trade, ticker, *trade)
+                except Exception as e:
+                    print(f"Error executing trade for '{ticker}': {e}")
+                last_trade = trade
+                if isinstance(order, Order):
+                    print(f"Order updated: {order.symbol} {order.side}: {order.qty} @ {order.limit_price}")
+
+    async def run():
+        nonlocal next_trade
+        worker = None
         # Main loop, continuously execute trades
-        while True:
-            latest_market_make = socket.recv_json()[ticker]
+        while not stop_event.is_set():
+            if not await socket.poll(1000):
+                continue  # Time out regularly to check the stop event
+            frames = await socket.recv_multipart(copy=False)
+            # Keep only the latest message
+            while True:
+                try:
+                    frames = await socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+            latest_market_make = unpack_price_frames(frames, (ticker,)).get(ticker)
+            if latest_market_make is None:
+                # The manager has not received a price for this ticker yet
+                continue
             got_ticker = latest_market_make['symbol']
             if got_ticker != ticker:
                 raise ValueError(f"TRADER ERROR: Received unexpected ticker '{got_ticker}', expected '{ticker}'.")
@@ -136,28 +355,30 @@ def individual_trade_execution(ticker, port):
             buy_quantity = 1
 
             # Validate timestamp
-            if time.time() - last_update > 5:
+            if time.time_ns() - last_update > 5_000_000_000:  # Timestamps are in nanoseconds
                 print(f"TRADER WARNING: Stale trade request for '{ticker}', clearing all pending orders.")
                 buy_price = None
                 sell_price = None
-            # Do no trade if prices are the same as last trade
-            if buy_price == last_buy and sell_price == last_sell and buy_quantity == last_qty:
-                time.sleep(0.01)
-                continue
-            # Execute trade
-            try:
-                order = execute_trade(ticker, buy_price, sell_price, buy_quantity)
-            except Exception as e:
-                print(f"Error executing trade for '{ticker}': {e}")
-            last_buy, last_sell, last_qty = buy_price, sell_price, buy_quantity
-            if isinstance(order, Order):
-                print(f"Order updated: {order.symbol} {order.side}: {order.qty} @ {order.limit_price}")
+            # Do no trade if prices are the same as last trade, skipping all Alpaca requests
+            next_trade = (buy_price, sell_price, buy_quantity)
+            if next_trade == last_trade:
+                continue  # The next receive already waits for a newer message
+            # Execute trade without blocking the next receive, an in-flight trade picks up the newest prices
+            if worker is None or worker.done():
+                worker = asyncio.create_task(trade_worker())
 
+    try:
+        asyncio.run(run())
     except Exception as e:
         print(f"Process encountered an error: {e}")
         raise e
     finally:
         # Clean up
+        if trading_stream is not None:
+            try:
+                trading_stream.stop()
+            except Exception:
+                pass  # The stream loop never started
+        executor.shutdown(wait=False, cancel_futures=True)
         socket.close()
-        context.term()
-        print("Socket and context closed.")
+        print("Socket closed.")